@@ -1,5 +1,7 @@
 import os
+import re
 import csv
+from bisect import bisect_left, bisect_right
 from transformers import pipeline
 import torch
 from tqdm import tqdm
@@ -7,6 +9,14 @@ from tqdm import tqdm
 MODEL_NAME = "hmoreira/xlm-roberta-large-petrogeoner"
 FILE_PATH = "../extracted_texts.txt"
 CSV_FILENAME = "../resultados_ner.csv"
+# "sentence" packs whole sentences (split on . ! ? or newlines) into windows; "fixed" uses plain token windows.
+# The texts produced by the extractor have no punctuation, so there sentences fall back to newline-separated
+# paragraphs, and paragraphs longer than MAX_WINDOW_TOKENS are split between words.
+WINDOW_MODE = os.environ.get("WINDOW_MODE", "sentence")
+MAX_WINDOW_TOKENS = 500
+OVERLAP_TOKENS = 50
+SENTENCE_OVERLAP_TOKENS = 16  # enough to keep an entity cut by a word split whole in one window
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n+')
 
 device = 0 if torch.cuda.is_available() else -1
 print(f"Using device: {'GPU' if device == 0 else 'CPU'}")
@@ -25,8 +35,8 @@ def load_text_from_file(filepath):
 
 
 def ner_with_chunks(text, ner_pipeline):
-    max_chunk_length = 500
-    overlap = 50
+    max_chunk_length = MAX_WINDOW_TOKENS
+    overlap = OVERLAP_TOKENS
     tokens = ner_pipeline.tokenizer(text, return_offsets_mapping=True, truncation=False)
     token_count = len(tokens['input_ids'])
 
@@ -54,19 +64,128 @@ def ner_with_chunks(text, ner_pipeline):
 
         if start_char_offset_index < len(tokens['offset_mapping']):
             start_offset_char = tokens['offset_mapping'][start_char_offset_index][0]
+            window_centre = start_offset_char + len(chunk_text) / 2
             for entity in chunk_results:
                 all_entities.append(
                     {'word': entity['word'], 'entity_group': entity['entity_group'], 'score': entity['score'],
-                     'start': entity['start'] + start_offset_char, 'end': entity['end'] + start_offset_char})
+                     'start': entity['start'] + start_offset_char, 'end': entity['end'] + start_offset_char,
+                     'window_centre': window_centre})
+
+    return merge_overlapping_entities(all_entities)
+
+
+def split_into_sentences(text):
+    """Returns the (start, end) character spans of the non-empty sentences in the text."""
+    spans = []
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(text):
+        if text[start:boundary.start()].strip():
+            spans.append((start, boundary.start()))
+        start = boundary.end()
+    if text[start:].strip():
+        spans.append((start, len(text)))
+    return spans
+
+
+def is_word_start(text, offset_start):
+    """Same test as the transformers token-classification pipeline: SentencePiece offsets may
+    include the leading space, so look at the characters on both sides of the offset."""
+    return offset_start == 0 or any(char.isspace() for char in text[offset_start - 1:offset_start + 1])
+
+
+def last_boundary_before(boundaries, start, limit):
+    """Returns the last boundary in (start, limit], or None when there is none."""
+    position = bisect_right(boundaries, limit) - 1
+    if position >= 0 and boundaries[position] > start:
+        return boundaries[position]
+    return None
+
+
+def build_sentence_windows(text, tokenizer, max_tokens=MAX_WINDOW_TOKENS, overlap_tokens=SENTENCE_OVERLAP_TOKENS):
+    """Packs whole sentences into (start, end) character windows of at most max_tokens tokens.
+
+    Windows end on a sentence boundary when one fills at least three quarters of the window;
+    consecutive windows then share only their boundary sentence, and only when it is shorter than
+    overlap_tokens. Otherwise the window is filled up to max_tokens and cut between words, with an
+    overlap of about overlap_tokens, so short sentences around a long one share its windows.
+    """
+    offsets = tokenizer(text, return_offsets_mapping=True, add_special_tokens=False,
+                        truncation=False)['offset_mapping']
+    token_count = len(offsets)
+    if not token_count:
+        return []
+
+    token_ends = [offset[1] for offset in offsets]
+    sentence_starts = sorted({bisect_right(token_ends, sentence_start)
+                              for sentence_start, _ in split_into_sentences(text)} | {token_count})
+    word_starts = [i for i, (offset_start, _) in enumerate(offsets) if i == 0 or is_word_start(text, offset_start)]
+
+    windows = []
+    start = 0
+    while start < token_count:
+        limit = start + max_tokens
+        if limit >= token_count:
+            end = next_start = token_count
+        else:
+            end = last_boundary_before(sentence_starts, start, limit)
+            position = bisect_left(sentence_starts, end) if end is not None else None
+            if end is not None and (end - start < max_tokens * 3 // 4
+                                    or sentence_starts[position + 1] - end > max_tokens):
+                # Cutting here would leave a quarter of the window unused, or the next sentence gets
+                # split anyway, so fill this window with the next words instead.
+                end = None
+            if end is not None:
+                last_sentence_start = sentence_starts[position - 1] if position > 0 else start
+                if last_sentence_start > start and end - last_sentence_start <= overlap_tokens:
+                    next_start = last_sentence_start
+                else:
+                    next_start = end
+            else:
+                end = last_boundary_before(word_starts, start, limit) or limit
+                next_start = last_boundary_before(word_starts, start, end - overlap_tokens) or end
+        windows.append((offsets[start][0], offsets[end - 1][1]))
+        start = next_start
+    return windows
+
+
+def ner_with_sentence_windows(text, ner_pipeline):
+    windows = build_sentence_windows(text, ner_pipeline.tokenizer)
+
+    print(f"Processing {len(windows)} sentence windows...")
+    all_entities = []
+
+    for window_start, window_end in tqdm(windows, desc="Processing Windows", unit="window"):
+        window_text = text[window_start:window_end]
+        if not window_text.strip(): continue
+
+        window_centre = (window_start + window_end) / 2
+        for entity in ner_pipeline(window_text):
+            all_entities.append(
+                {'word': entity['word'], 'entity_group': entity['entity_group'], 'score': entity['score'],
+                 'start': entity['start'] + window_start, 'end': entity['end'] + window_start,
+                 'window_centre': window_centre})
 
-    unique_entities = []
-    seen_entities = set()
-    for entity in sorted(all_entities, key=lambda x: x['start']):
-        entity_id = (entity['start'], entity['end'], entity['entity_group'])
-        if entity_id not in seen_entities:
-            unique_entities.append(entity)
-            seen_entities.add(entity_id)
-    return unique_entities
+    return merge_overlapping_entities(all_entities)
+
+
+def merge_overlapping_entities(entities):
+    """Keeps one prediction per overlapping region, preferring the higher score and then the
+    span that lies closer to the centre of the window it was predicted in."""
+    def priority(entity):
+        centre_distance = abs((entity['start'] + entity['end']) / 2 - entity['window_centre'])
+        return -entity['score'], centre_distance
+
+    kept_starts, kept_ends, kept = [], [], []
+    for entity in sorted(entities, key=priority):
+        position = bisect_right(kept_starts, entity['start'])
+        if position > 0 and kept_ends[position - 1] > entity['start']:
+            continue
+        if position < len(kept_starts) and kept_starts[position] < entity['end']:
+            continue
+        kept_starts.insert(position, entity['start'])
+        kept_ends.insert(position, entity['end'])
+        kept.insert(position, {key: value for key, value in entity.items() if key != 'window_centre'})
+    return kept
 
 
 def collapse_and_aggregate_entities(entities):
@@ -113,7 +232,10 @@ if text:
     print(f"--- Text loaded for analysis (Size: {len(text)} chars) ---\n")
     try:
         ner_pipeline = pipeline("ner", model=MODEL_NAME, aggregation_strategy="first", device=device)
-        raw_results = ner_with_chunks(text, ner_pipeline)
+        if WINDOW_MODE == "fixed":
+            raw_results = ner_with_chunks(text, ner_pipeline)
+        else:
+            raw_results = ner_with_sentence_windows(text, ner_pipeline)
         summarized_results = collapse_and_aggregate_entities(raw_results)
 
         print(f"\n--- NUMBER OF UNIQUE ENTITIES (Total: {len(summarized_results)}) ---")
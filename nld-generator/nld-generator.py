@@ -13,6 +13,25 @@ except KeyError:
 
 MODEL_NAME = "gemini-2.5-pro"
 FILE_PATH = "../consolidated_terms_with_labels.csv"
+RESULTS_FILE_PATH = "nlds_generated.csv"
+REVIEW_FILE_PATH = "termos_para_revisao_manual.csv"
+DEFERRED_FILE_PATH = "termos_adiados.csv"
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 3))  # termos com erro vão para revisão manual após esse número
+MAX_REQUESTS = int(os.environ.get("MAX_REQUESTS", 0))  # 0 = sem limite
+# 0 = sem limite. Verificado antes de cada termo com a média de tokens realmente usados por requisição
+# (incluindo tokens de raciocínio), então o último termo de uma execução ainda pode ultrapassá-lo um pouco.
+MAX_ESTIMATED_TOKENS = int(os.environ.get("MAX_ESTIMATED_TOKENS", 0))
+PRIORITY_LABELS = [label.strip() for label in os.environ.get("PRIORITY_LABELS", "").split(",") if label.strip()]
+CHARS_PER_TOKEN = 4
+OUTPUT_TOKENS_PER_REQUEST = 256
+REQUESTS_PER_TERM = 2
+REQUIRED_COLUMNS = ['Readable_Term', 'Label']
+OPTIONAL_COLUMNS = ['Frequency', 'Tentativas']
+
+if 0 < MAX_REQUESTS < REQUESTS_PER_TERM:
+    print(f"ERRO: MAX_REQUESTS={MAX_REQUESTS} não permite processar nenhum termo "
+          f"(cada termo usa até {REQUESTS_PER_TERM} requisições).")
+    exit()
 
 generation_config = genai.GenerationConfig(
     temperature=0.1,
@@ -24,7 +43,12 @@ def load_terms_and_labels_from_csv(filepath):
         print(f"ERRO: O arquivo '{filepath}' não foi encontrado.")
         return None
     try:
-        df = pd.read_csv(filepath, encoding='utf-8', delimiter=',', header=0, usecols=['Readable_Term', 'Label'])
+        df = pd.read_csv(filepath, encoding='utf-8-sig', delimiter=',', header=0,
+                         usecols=lambda column: column in REQUIRED_COLUMNS + OPTIONAL_COLUMNS)
+        colunas_ausentes = [column for column in REQUIRED_COLUMNS if column not in df.columns]
+        if colunas_ausentes:
+            print(f"ERRO: Colunas obrigatórias {colunas_ausentes} não encontradas em '{filepath}'.")
+            return None
         print(f"Sucesso! {len(df)} termos e rótulos carregados de '{filepath}'.")
         return df
     except Exception as e:
@@ -32,6 +56,97 @@ def load_terms_and_labels_from_csv(filepath):
         return None
 
 
+def label_priority(label):
+    """Retorna a posição do rótulo (ou de um de seus rótulos combinados) em PRIORITY_LABELS."""
+    positions = [PRIORITY_LABELS.index(part.strip()) for part in str(label).split('|')
+                 if part.strip() in PRIORITY_LABELS]
+    return min(positions) if positions else len(PRIORITY_LABELS)
+
+
+def schedule_terms(df):
+    """Ordena os termos por rótulo prioritário (se configurado) e por frequência decrescente."""
+    sort_columns, ascending = [], []
+    if PRIORITY_LABELS:
+        df = df.assign(_prioridade=df['Label'].map(label_priority))
+        sort_columns.append('_prioridade')
+        ascending.append(True)
+    if 'Frequency' in df.columns:
+        sort_columns.append('Frequency')
+        ascending.append(False)
+    if sort_columns:
+        df = df.sort_values(sort_columns, ascending=ascending, kind='stable')
+    return df.drop(columns=['_prioridade'], errors='ignore').reset_index(drop=True)
+
+
+def term_keys(df, term_column, label_column):
+    """Retorna os pares (termo, rótulo) das linhas; um termo pode aparecer uma vez por rótulo."""
+    return list(zip(df[term_column], df[label_column]))
+
+
+def load_processed_terms():
+    """Retorna os pares (termo, rótulo) originais já salvos nos resultados ou na revisão manual."""
+    processados = set()
+    for filepath, coluna_rotulo in [(RESULTS_FILE_PATH, 'Rótulo_Original'), (REVIEW_FILE_PATH, 'Label')]:
+        if not os.path.exists(filepath):
+            continue
+        try:
+            df = pd.read_csv(filepath, encoding='utf-8-sig')
+        except Exception as e:
+            print(f"ERRO ao ler os termos já processados em '{filepath}': {e}")
+            exit()
+        if 'Termo_Original' in df.columns:
+            processados |= set(term_keys(df, 'Termo_Original', coluna_rotulo))
+    return processados
+
+
+def build_schedule(df_input, df_deferred, processed_terms):
+    """Termos adiados primeiro, depois os termos de entrada que não foram processados nem adiados."""
+    df_deferred = df_deferred[[key not in processed_terms
+                               for key in term_keys(df_deferred, 'Readable_Term', 'Label')]]
+    done_terms = processed_terms | set(term_keys(df_deferred, 'Readable_Term', 'Label'))
+    df_pending = df_input[[key not in done_terms for key in term_keys(df_input, 'Readable_Term', 'Label')]]
+    return pd.concat([df_deferred, schedule_terms(df_pending)], ignore_index=True)
+
+
+def previous_attempts(row):
+    """Número de tentativas com erro já registradas para o termo (0 se nunca falhou)."""
+    value = row.get('Tentativas')
+    return 0 if pd.isna(value) else int(value)
+
+
+def estimate_tokens(*texts):
+    """Estimativa grosseira do número de tokens de entrada a partir do número de caracteres."""
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN + 1
+
+
+def response_tokens(response, estimated):
+    """Usa a contagem real de tokens da resposta quando disponível."""
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', 0) or estimated
+
+
+def next_request_tokens(tokens_used, completed_requests, estimated):
+    """Média de tokens realmente usados por requisição concluída, ou a estimativa do prompt antes da primeira."""
+    if not completed_requests:
+        return estimated
+    return max(estimated, tokens_used // completed_requests)
+
+
+def budget_exceeded(requests_used, tokens_used, term_tokens):
+    if MAX_REQUESTS and requests_used + REQUESTS_PER_TERM > MAX_REQUESTS:
+        return True
+    return bool(MAX_ESTIMATED_TOKENS and tokens_used + term_tokens > MAX_ESTIMATED_TOKENS)
+
+
+def save_csv(rows, filepath, append):
+    """Salva as linhas em CSV, acrescentando-as ao conteúdo existente quando append=True."""
+    df = pd.DataFrame(rows)
+    if append and os.path.exists(filepath):
+        df = pd.concat([pd.read_csv(filepath, encoding='utf-8-sig'), df], ignore_index=True)
+    df.to_csv(filepath, index=False, encoding='utf-8-sig')
+    return len(df)
+
+
 system_instruction_correcao = "You are a data processing assistant specializing in correcting and standardizing technical terms from the geology domain."
 
 prompt_template_correcao = """"Your task is to correct and format the following technical term according to strict geological and petroleum domain standards. Follow these rules precisely:
@@ -60,11 +175,25 @@ Term to be defined: "{termo_corrigido}"
 Assigned Label: "{rotulo_ner}"
 """
 
+retomando = os.path.exists(DEFERRED_FILE_PATH)
 df_termos = load_terms_and_labels_from_csv(FILE_PATH)
+if df_termos is not None:
+    if retomando:
+        print(f"Retomando execução anterior: os termos adiados em '{DEFERRED_FILE_PATH}' são processados primeiro.")
+        df_adiados_anteriores = load_terms_and_labels_from_csv(DEFERRED_FILE_PATH)
+        if df_adiados_anteriores is None:
+            exit()
+        df_termos = build_schedule(df_termos, df_adiados_anteriores, load_processed_terms())
+    else:
+        df_termos = schedule_terms(df_termos)
 
 if df_termos is not None:
     resultados = []
     termos_para_revisao = []
+    termos_adiados = []
+    requisicoes_usadas = 0
+    requisicoes_concluidas = 0
+    tokens_usados = 0
 
     model_correcao = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=system_instruction_correcao,
                                            generation_config=generation_config)
@@ -75,12 +204,27 @@ if df_termos is not None:
     for index, row in df_termos.iterrows():
         termo_bruto = row['Readable_Term']
         rotulo_ner = row['Label']
+        frequencia = row.get('Frequency')
+
+        prompt_correcao = prompt_template_correcao.format(termo_bruto=termo_bruto)
+        tokens_correcao = estimate_tokens(system_instruction_correcao, prompt_correcao) + OUTPUT_TOKENS_PER_REQUEST
+        tokens_definicao = estimate_tokens(system_instruction_definicao, prompt_template_definicao,
+                                           termo_bruto, str(rotulo_ner)) + OUTPUT_TOKENS_PER_REQUEST
+        tokens_correcao = next_request_tokens(tokens_usados, requisicoes_concluidas, tokens_correcao)
+        tokens_definicao = next_request_tokens(tokens_usados, requisicoes_concluidas, tokens_definicao)
+        if budget_exceeded(requisicoes_usadas, tokens_usados, tokens_correcao + tokens_definicao):
+            termos_adiados.append(df_termos.iloc[index:])
+            print(f"Orçamento atingido ({requisicoes_usadas} requisições, ~{tokens_usados} tokens). "
+                  f"{total_termos - index} termos adiados para a próxima execução.")
+            break
 
         print(f"Processando termo {index + 1}/{total_termos}: '{termo_bruto}'...")
 
         try:
-            response_correcao = model_correcao.generate_content(
-                prompt_template_correcao.format(termo_bruto=termo_bruto))
+            requisicoes_usadas += 1
+            response_correcao = model_correcao.generate_content(prompt_correcao)
+            tokens_usados += response_tokens(response_correcao, tokens_correcao)
+            requisicoes_concluidas += 1
             termo_corrigido = response_correcao.text.strip()
 
             if termo_corrigido == "UNKNOWN_TERM" or len(termo_corrigido.split()) > 5:
@@ -90,8 +234,11 @@ if df_termos is not None:
                 time.sleep(1)
                 continue
 
+            requisicoes_usadas += 1
             response_definicao = model_definicao.generate_content(
                 prompt_template_definicao.format(termo_corrigido=termo_corrigido, rotulo_ner=rotulo_ner))
+            tokens_usados += response_tokens(response_definicao, tokens_definicao)
+            requisicoes_concluidas += 1
             nld_gerada = response_definicao.text.strip()
 
             if "não tenho informações" in nld_gerada.lower() or "termo desconhecido" in nld_gerada.lower() or len(
@@ -101,21 +248,35 @@ if df_termos is not None:
             else:
                 print(f"  -> Definição gerada com sucesso.")
                 resultados.append(
-                    {'Termo_Corrigido': termo_corrigido, 'NLD': nld_gerada, 'Rótulo_Original': rotulo_ner})
+                    {'Termo_Corrigido': termo_corrigido, 'NLD': nld_gerada, 'Rótulo_Original': rotulo_ner,
+                     'Frequency': frequencia, 'Termo_Original': termo_bruto})
 
             time.sleep(1)
 
         except Exception as e:
-            print(f"  -> ERRO ao processar o termo '{termo_bruto}': {e}")
-            termos_para_revisao.append({'Termo_Original': termo_bruto, 'Label': rotulo_ner, 'Erro': str(e)})
+            tentativas = previous_attempts(row) + 1
+            if tentativas >= MAX_ATTEMPTS:
+                print(f"  -> ERRO ao processar o termo '{termo_bruto}': {e}. "
+                      f"Marcado para revisão manual após {tentativas} tentativas.")
+                termos_para_revisao.append({'Termo_Original': termo_bruto, 'Label': rotulo_ner, 'Erro': str(e),
+                                            'Tentativas': tentativas})
+            else:
+                print(f"  -> ERRO ao processar o termo '{termo_bruto}': {e}. Termo adiado para a próxima execução.")
+                termos_adiados.append(df_termos.iloc[[index]].assign(Tentativas=tentativas))
 
     print("\nProcessamento concluído. Salvando resultados...")
 
-    df_resultados = pd.DataFrame(resultados)
-    df_resultados.to_csv('nlds_generated.csv', index=False, encoding='utf-8-sig')
-    print(f"{len(df_resultados)} definições salvas em 'nlds_generated.csv'")
+    total_resultados = save_csv(resultados, RESULTS_FILE_PATH, append=retomando)
+    print(f"{len(resultados)} novas definições geradas ({total_resultados} salvas em '{RESULTS_FILE_PATH}')")
 
     if termos_para_revisao:
-        df_revisao = pd.DataFrame(termos_para_revisao)
-        df_revisao.to_csv('termos_para_revisao_manual.csv', index=False, encoding='utf-8-sig')
-        print(f"{len(df_revisao)} termos para revisão manual salvos em 'termos_para_revisao_manual.csv'")
\ No newline at end of file
+        total_revisao = save_csv(termos_para_revisao, REVIEW_FILE_PATH, append=retomando)
+        print(f"{total_revisao} termos para revisão manual salvos em '{REVIEW_FILE_PATH}'")
+
+    if termos_adiados:
+        df_adiados = pd.concat(termos_adiados, ignore_index=True)
+        df_adiados.to_csv(DEFERRED_FILE_PATH, index=False, encoding='utf-8-sig')
+        print(f"{len(df_adiados)} termos adiados salvos em '{DEFERRED_FILE_PATH}'")
+    elif retomando:
+        os.remove(DEFERRED_FILE_PATH)
+        print(f"Todos os termos adiados foram processados. '{DEFERRED_FILE_PATH}' removido.")
\ No newline at end of file
@@ -15,6 +15,18 @@ BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 10))
 MODEL_NAME = "gemini-2.5-pro"
 INPUT_FILE_PATH = "../nlds_generated.csv"
 OUTPUT_FILE_PATH = "../output/classified_terms.csv"
+DEFERRED_FILE_PATH = "../output/deferred_terms.csv"
+REVIEW_FILE_PATH = "../output/terms_for_manual_review.csv"
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 3))  # failed terms go to manual review after this many
+MAX_REQUESTS = int(os.environ.get("MAX_REQUESTS", 0))  # 0 = unlimited
+# 0 = unlimited. Checked before each request against the average tokens actually used per request
+# (including thinking tokens), so the last request of a run can still overshoot it slightly.
+MAX_ESTIMATED_TOKENS = int(os.environ.get("MAX_ESTIMATED_TOKENS", 0))
+PRIORITY_LABELS = [label.strip() for label in os.environ.get("PRIORITY_LABELS", "").split(",") if label.strip()]
+CHARS_PER_TOKEN = 4
+OUTPUT_TOKENS_PER_TERM = 100
+REQUIRED_COLUMNS = ['Termo_Corrigido', 'NLD', 'Rótulo_Original']
+OPTIONAL_COLUMNS = ['Frequency', 'Attempts']
 GEORESERVOIR_DEFS_PATH = "../resources/georeservoir-definitions.txt"
 GEOCORE_DEFS_PATH = "../resources/geocore-definitions.txt"
 BFO_DEFS_PATH = "../resources/bfo-definitions.txt"
@@ -53,8 +65,12 @@ def load_nlds_from_csv(filepath):
         print(f"ERROR: The file '{filepath}' was not found.")
         return None
     try:
-        df = pd.read_csv(filepath, encoding='utf-8', delimiter=',', header=0,
-                         usecols=['Termo_Corrigido', 'NLD', 'Rótulo_Original'])
+        df = pd.read_csv(filepath, encoding='utf-8-sig', delimiter=',', header=0,
+                         usecols=lambda column: column in REQUIRED_COLUMNS + OPTIONAL_COLUMNS)
+        missing_columns = [column for column in REQUIRED_COLUMNS if column not in df.columns]
+        if missing_columns:
+            print(f"ERROR: Required columns {missing_columns} not found in '{filepath}'.")
+            return None
         print(f"Success! {len(df)} terms, NLDs, and labels loaded from '{filepath}'.")
         return df
     except Exception as e:
@@ -62,6 +78,96 @@ def load_nlds_from_csv(filepath):
         return None
 
 
+def label_priority(label):
+    """Returns the position of the label (or of any of its combined labels) in PRIORITY_LABELS."""
+    positions = [PRIORITY_LABELS.index(part.strip()) for part in str(label).split('|')
+                 if part.strip() in PRIORITY_LABELS]
+    return min(positions) if positions else len(PRIORITY_LABELS)
+
+
+def schedule_terms(df):
+    """Orders terms by priority label (if configured) and then by descending frequency."""
+    sort_columns, ascending = [], []
+    if PRIORITY_LABELS:
+        df = df.assign(_priority=df['Rótulo_Original'].map(label_priority))
+        sort_columns.append('_priority')
+        ascending.append(True)
+    if 'Frequency' in df.columns:
+        sort_columns.append('Frequency')
+        ascending.append(False)
+    else:
+        print("No 'Frequency' column found. Keeping CSV order within each label priority.")
+    if sort_columns:
+        df = df.sort_values(sort_columns, ascending=ascending, kind='stable')
+    return df.drop(columns=['_priority'], errors='ignore').reset_index(drop=True)
+
+
+def term_keys(df, term_column, label_column):
+    """Returns the (term, label) pairs of the rows; a term can appear once per label."""
+    return list(zip(df[term_column], df[label_column]))
+
+
+def load_classified_terms(filepath):
+    """Returns the (term, label) pairs already present in the classification output."""
+    if not os.path.exists(filepath):
+        return set()
+    try:
+        df = pd.read_csv(filepath, encoding='utf-8-sig', usecols=['Term', 'Original_Label'])
+        return set(term_keys(df, 'Term', 'Original_Label'))
+    except Exception as e:
+        print(f"ERROR reading previous classifications from '{filepath}': {e}")
+        exit()
+
+
+def build_schedule(df_input, df_deferred, classified_terms):
+    """Deferred terms first, then the scheduled input terms that were neither classified nor deferred."""
+    df_deferred = df_deferred[[key not in classified_terms
+                               for key in term_keys(df_deferred, 'Termo_Corrigido', 'Rótulo_Original')]]
+    done_terms = classified_terms | set(term_keys(df_deferred, 'Termo_Corrigido', 'Rótulo_Original'))
+    df_pending = df_input[[key not in done_terms
+                           for key in term_keys(df_input, 'Termo_Corrigido', 'Rótulo_Original')]]
+    return pd.concat([df_deferred, schedule_terms(df_pending)], ignore_index=True)
+
+
+def count_failed_attempt(batch_df):
+    """Adds one attempt to every term in the batch and splits it into (to retry, to review)."""
+    previous_attempts = batch_df['Attempts'].fillna(0).astype(int) if 'Attempts' in batch_df.columns else 0
+    batch_df = batch_df.assign(Attempts=previous_attempts + 1)
+    exhausted = batch_df['Attempts'] >= MAX_ATTEMPTS
+    return batch_df[~exhausted], batch_df[exhausted]
+
+
+def save_csv(df, filepath, append):
+    """Saves the rows to CSV, after the rows already in the file when append=True."""
+    if append and os.path.exists(filepath):
+        df = pd.concat([pd.read_csv(filepath, encoding='utf-8-sig'), df], ignore_index=True)
+    df.to_csv(filepath, index=False, encoding='utf-8-sig')
+
+
+def estimate_tokens(text):
+    """Rough input token estimate based on character count."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def response_tokens(response, estimated):
+    """Uses the response's actual token count when available."""
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', 0) or estimated
+
+
+def next_request_tokens(tokens_used, completed_requests, estimated):
+    """Average tokens actually used per completed request, or the prompt estimate before the first one."""
+    if not completed_requests:
+        return estimated
+    return max(estimated, tokens_used // completed_requests)
+
+
+def budget_exceeded(requests_used, tokens_used, batch_tokens):
+    if MAX_REQUESTS and requests_used + 1 > MAX_REQUESTS:
+        return True
+    return bool(MAX_ESTIMATED_TOKENS and tokens_used + batch_tokens > MAX_ESTIMATED_TOKENS)
+
+
 system_instruction = "You are an expert ontology engineer specializing in foundational (BFO) and geological (GeoCore and GeoReservoir) ontologies. You process data in batches and your response format MUST be a valid JSON array of objects."
 prompt_template = """Your task is to classify a batch of geological terms based on their Natural Language Definitions (NLDs).
 
@@ -94,10 +200,27 @@ prompt_template = """Your task is to classify a batch of geological terms based
 {json_batch}
 """
 
+resuming = os.path.exists(DEFERRED_FILE_PATH)
 df_nlds = load_nlds_from_csv(INPUT_FILE_PATH)
+if df_nlds is not None:
+    if resuming:
+        print(f"Resuming previous run: deferred terms in '{DEFERRED_FILE_PATH}' are processed first.")
+        df_deferred = load_nlds_from_csv(DEFERRED_FILE_PATH)
+        if df_deferred is None:
+            exit()
+        classified_terms = load_classified_terms(OUTPUT_FILE_PATH)
+        print(f"Skipping {len(classified_terms)} terms already classified in '{OUTPUT_FILE_PATH}'.")
+        df_nlds = build_schedule(df_nlds, df_deferred, classified_terms)
+    else:
+        df_nlds = schedule_terms(df_nlds)
 
 if df_nlds is not None:
     classification_results = []
+    deferred_batches = []
+    review_batches = []
+    requests_used = 0
+    completed_requests = 0
+    tokens_used = 0
     model = genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=system_instruction,
                                   generation_config=generation_config)
     total_terms = len(df_nlds)
@@ -113,34 +236,50 @@ if df_nlds is not None:
             })
         json_batch_str = json.dumps(batch_list, indent=2)
 
+        final_prompt = prompt_template.format(geocore_definitions=geocore_definitions,
+                                              bfo_definitions=bfo_definitions,
+                                              georeservoir_definitions= georeservoir_definitions,
+                                              json_batch=json_batch_str)
+        batch_tokens = estimate_tokens(system_instruction + final_prompt) + OUTPUT_TOKENS_PER_TERM * len(batch_df)
+        batch_tokens = next_request_tokens(tokens_used, completed_requests, batch_tokens)
+        if budget_exceeded(requests_used, tokens_used, batch_tokens):
+            deferred_batches.append(df_nlds.iloc[i:])
+            print(f"Budget reached ({requests_used} requests, ~{tokens_used} tokens). "
+                  f"{total_terms - i} terms deferred to the next run.")
+            break
+
         print(f"Classifying batch of terms {i + 1}-{min(i + BATCH_SIZE, total_terms)} of {total_terms}...")
         try:
-            final_prompt = prompt_template.format(geocore_definitions=geocore_definitions,
-                                                  bfo_definitions=bfo_definitions,
-                                                  georeservoir_definitions= georeservoir_definitions,
-                                                  json_batch=json_batch_str)
+            requests_used += 1
             response = model.generate_content(final_prompt)
+            tokens_used += response_tokens(response, batch_tokens)
+            completed_requests += 1
             response_json = json.loads(response.text)
 
             if len(response_json) != len(batch_df):
                 raise ValueError("LLM response length does not match batch size.")
 
+            batch_results = []
             for idx, result_item in enumerate(response_json):
                 original_row = batch_df.iloc[idx]
 
-                classification_results.append({
+                batch_results.append({
                     'Term': original_row['Termo_Corrigido'],
                     'Category': result_item['category'],
                     'Original_Label': original_row['Rótulo_Original'],
                     'Reasoning': result_item['reasoning'],
                     'NLD': original_row['NLD']
                 })
+            classification_results.extend(batch_results)
             print("  -> Batch classified and saved successfully.")
 
-        except json.JSONDecodeError:
-            print(f"  -> ERROR: LLM returned invalid JSON. Batch flagged for review.")
         except Exception as e:
-            print(f"  -> ERROR classifying batch: {e}. Batch flagged for review.")
+            reason = "LLM returned invalid JSON" if isinstance(e, json.JSONDecodeError) else str(e)
+            retry_df, review_df = count_failed_attempt(batch_df)
+            print(f"  -> ERROR classifying batch: {reason}. {len(retry_df)} terms deferred to the next run, "
+                  f"{len(review_df)} flagged for manual review after {MAX_ATTEMPTS} attempts.")
+            deferred_batches.append(retry_df)
+            review_batches.append(review_df.assign(Reason=reason))
 
         time.sleep(2)
 
@@ -159,9 +298,29 @@ if df_nlds is not None:
         final_df = pd.DataFrame(classification_results)
 
         column_order = ['Term', 'Category', 'Reasoning', 'Original_Label', 'NLD']
-        final_df = final_df[column_order]  # Reorder columns
+        final_df = final_df.reindex(columns=column_order)  # Reorder columns
 
-        final_df.to_csv(OUTPUT_FILE_PATH, index=False, encoding='utf-8-sig')
+        save_csv(final_df, OUTPUT_FILE_PATH, append=resuming)
         print(f"Classification results successfully saved to '{OUTPUT_FILE_PATH}'")
+
+        review_df = pd.concat(review_batches, ignore_index=True) if review_batches else pd.DataFrame()
+        if not review_df.empty:
+            review_df = review_df.rename(columns={'Termo_Corrigido': 'Term', 'Rótulo_Original': 'Original_Label'})
+            review_df = review_df.reindex(columns=['Term', 'Original_Label', 'NLD', 'Reason', 'Attempts'])
+            save_csv(review_df, REVIEW_FILE_PATH, append=resuming)
+            print(f"{len(review_df)} terms flagged for manual review saved to '{REVIEW_FILE_PATH}'")
+    except Exception as e:
+        print(f"ERROR saving results to CSV file '{OUTPUT_FILE_PATH}': {e}")
+        print(f"Deferred terms file '{DEFERRED_FILE_PATH}' left unchanged.")
+        exit()
+
+    try:
+        deferred_df = pd.concat(deferred_batches, ignore_index=True) if deferred_batches else pd.DataFrame()
+        if not deferred_df.empty:
+            deferred_df.to_csv(DEFERRED_FILE_PATH, index=False, encoding='utf-8-sig')
+            print(f"{len(deferred_df)} deferred terms saved to '{DEFERRED_FILE_PATH}'")
+        elif os.path.exists(DEFERRED_FILE_PATH):
+            os.remove(DEFERRED_FILE_PATH)
+            print(f"All deferred terms processed. Removed '{DEFERRED_FILE_PATH}'.")
     except Exception as e:
-        print(f"ERROR saving results to CSV file '{OUTPUT_FILE_PATH}': {e}")
\ No newline at end of file
+        print(f"ERROR updating deferred terms file '{DEFERRED_FILE_PATH}': {e}")
\ No newline at end of file